@@ -1,19 +1,28 @@
+import asyncio
 import logging
+import os
 import platform
 import re
 import stat
+import sys
 from asyncio import iscoroutinefunction
-from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from functools import cached_property, partial, wraps
 from pathlib import Path
+from queue import Queue
 from subprocess import PIPE, Popen
 from tempfile import gettempdir
-from typing import Callable, Coroutine, Optional, Sequence, Union
+from threading import Event, Thread
+from typing import Callable, Coroutine, Iterator, Optional, Sequence, Union
 import requests
 
 __all__ = ["Megatools", "MegaError"]
 
 logger = logging.getLogger(Path(__file__).stem)
 
+_ERROR_PREFIX_RE = re.compile(r"\w+: ")
+
 
 class MegaError(Exception):
     """Exception for all errors with megatools"""
@@ -22,11 +31,19 @@ class MegaError(Exception):
         super().__init__(*args)
 
 
-Stream = list[str]
+Stream = bytearray
+
+CHUNK_SIZE = 1 << 16
+
+QUEUE_SIZE = 16
 
+EXECUTABLE_MODE = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
 
-def to_string(*seq: Sequence) -> tuple[str, ...]:
-    return tuple("".join(s) for s in seq)
+FILENAME_WORKERS = 8
+
+
+def to_string(*seq: Stream) -> tuple[str, ...]:
+    return tuple(s.decode(errors="ignore") for s in seq)
 
 
 def parse_options(command: list[str], **options):
@@ -38,18 +55,70 @@ def parse_options(command: list[str], **options):
         command.append(f"--{option}={value}")
 
 
-def execute(command: list[str], on_read: Optional[Callable] = None, *args) -> tuple:
+def pump(f, index: int, queue: Queue) -> None:
+    end = b""
+    try:
+        for chunk in iter(partial(f.read1, CHUNK_SIZE), b""):
+            queue.put((index, chunk))
+    except Exception as error:
+        end = error
+    finally:
+        queue.put((index, end))
+
+
+def read_streams(process: Popen) -> Iterator[tuple[int, bytes]]:
+    """Yield `(index, chunk)` pairs from stdout (0) and stderr (1) as they arrive
+
+    Both pipes are drained concurrently so a process that fills one of them
+    never blocks while we are still waiting on the other. At most
+    `QUEUE_SIZE` chunks are held in memory, after that the reader threads wait
+    for the consumer, which lets the pipes push back on the process again.
+    Errors raised while reading a pipe are re-raised here. If the generator is
+    closed early the process is killed.
+    """
+    queue = Queue(maxsize=QUEUE_SIZE)
+    pipes = (process.stdout, process.stderr)
+    for index, f in enumerate(pipes):
+        Thread(target=pump, args=(f, index, queue), daemon=True).start()
+    remaining = len(pipes)
+    try:
+        while remaining:
+            index, chunk = queue.get()
+            if isinstance(chunk, Exception):
+                remaining -= 1
+                raise chunk
+            if not chunk:
+                remaining -= 1
+                continue
+            yield index, chunk
+    finally:
+        if remaining:
+            process.kill()
+            while remaining:
+                _, chunk = queue.get()
+                if isinstance(chunk, Exception) or not chunk:
+                    remaining -= 1
+            process.wait()
+
+
+def execute(
+    command: list[str],
+    on_read: Optional[Callable] = None,
+    *args,
+    on_spawn: Optional[Callable] = None,
+) -> tuple:
     if on_read:
         assert not iscoroutinefunction(on_read), "`on_read` function must be sync!"
     process = Popen(command, stdout=PIPE, stderr=PIPE)
-    streams: list[Stream] = []
-    for f in (process.stdout, process.stderr):
-        stream = Stream()
-        for char in iter(lambda: f.readline(), b""):
-            stream.append(char.decode(errors="ignore"))
+    if on_spawn:
+        on_spawn(process)
+    streams = (Stream(), Stream())
+    with closing(read_streams(process)) as chunks:
+        for index, chunk in chunks:
+            stream = streams[index]
+            stream.extend(chunk)
             if on_read:
-                on_read(stream, process, *args)
-        streams.append(stream)
+                on_read(stream, chunk, process, *args)
     return (*to_string(*streams), process.wait())
 
 
@@ -58,20 +127,56 @@ async def async_execute(
 ) -> tuple:
     if on_read:
         assert iscoroutinefunction(on_read), "`on_read` function must be async!"
-    process = Popen(command, stdout=PIPE, stderr=PIPE)
-    streams: list[Stream] = []
-    for f in (process.stdout, process.stderr):
-        stream = Stream()
-        for char in iter(lambda: f.readline(), b""):
-            stream.append(char.decode(errors="ignore"))
+    process = await asyncio.create_subprocess_exec(
+        command[0],
+        *command[1:],
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def read(reader: asyncio.StreamReader, stream: Stream) -> None:
+        while chunk := await reader.read(CHUNK_SIZE):
+            stream.extend(chunk)
             if on_read:
-                await on_read(stream, process, *args)
-        streams.append(stream)
-    return (*to_string(*streams), process.wait())
-
-
-def default_callback(stream: Stream, _) -> None:
-    print(end=stream[-1])
+                await on_read(stream, chunk, process, *args)
+
+    streams = (Stream(), Stream())
+    readers = (
+        asyncio.create_task(read(process.stdout, streams[0])),
+        asyncio.create_task(read(process.stderr, streams[1])),
+    )
+    try:
+        *_, returncode = await asyncio.gather(*readers, process.wait())
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+        for reader in readers:
+            reader.cancel()
+        await process.wait()
+        raise
+    return (*to_string(*streams), returncode)
+
+
+_stdout_state: tuple = (None, None, False)
+
+
+def default_callback(stream: Stream, chunk: bytes, _) -> None:
+    global _stdout_state
+    stdout, buffer, interactive = _stdout_state
+    if stdout is not sys.stdout:
+        stdout = sys.stdout
+        buffer = getattr(stdout, "buffer", None)
+        interactive = buffer is not None and buffer.isatty()
+        _stdout_state = stdout, buffer, interactive
+    if buffer is None:
+        stdout.write(chunk.decode(errors="ignore"))
+        return
+    if len(stream) == len(chunk):
+        # First chunk of this stream, push out any text printed before it
+        stdout.flush()
+    buffer.write(chunk)
+    if interactive:
+        buffer.flush()
 
 
 @wraps(default_callback)
@@ -80,38 +185,49 @@ async def default_async_callback(*args, **kwargs) -> None:
 
 
 def parse_and_raise(returncode:int, error: str) -> None:
-    pattern = re.compile(r"\w+: ")
-    match = pattern.search(error)
+    match = _ERROR_PREFIX_RE.search(error)
     if match:
-        error = error.replace(match.group(0), "", 1)
+        error = error[: match.start()] + error[match.end() :]
     raise MegaError(returncode, f"[returnCode {returncode}] {error}")
 
 
 class Megatools:
-    def __init__(self, executable: Union[Path, str] = None) -> None:
+    def __init__(
+        self, executable: Union[Path, str] = None, max_workers: Optional[int] = None
+    ) -> None:
         """Setup new instance of Megatools
 
         Args:
             executable (Union[Path, str], optional): Path to the megatools executable. Downloads executable if this is None (default)
+            max_workers (int, optional): Maximum number of downloads run at once by `download_in_thread`. Defaults to the ThreadPoolExecutor default
         """
         self.tmp_directory = Path(gettempdir())
+        self._max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
         if not executable:
             executable = self.tmp_directory / "megatools"
-            if not executable.exists():
+            try:
+                mode = executable.stat().st_mode
+            except FileNotFoundError:
                 logger.info("Downloading executable..")
                 url = "https://raw.githubusercontent.com/justaprudev/megatools/master/megatools"
-                binary = requests.get(
-                    f"{url}.exe" if platform.system() == "Windows" else url
-                )
-                with open(executable, "wb") as f:
-                    f.write(binary.content)
-                executable.chmod(
-                    executable.stat().st_mode
-                    | stat.S_IXUSR
-                    | stat.S_IXGRP
-                    | stat.S_IXOTH
-                )
-        self.executable = str(executable)
+                partial_executable = executable.with_name(f"{executable.name}.part")
+                try:
+                    with requests.get(
+                        f"{url}.exe" if platform.system() == "Windows" else url,
+                        stream=True,
+                    ) as binary:
+                        binary.raise_for_status()
+                        with open(partial_executable, "wb") as f:
+                            for chunk in binary.iter_content(chunk_size=CHUNK_SIZE):
+                                f.write(chunk)
+                    os.replace(partial_executable, executable)
+                finally:
+                    partial_executable.unlink(missing_ok=True)
+                mode = executable.stat().st_mode
+            if mode & EXECUTABLE_MODE != EXECUTABLE_MODE:
+                executable.chmod(mode | EXECUTABLE_MODE)
+        self.executable = os.fsdecode(executable)
 
     def download(
         self,
@@ -125,7 +241,7 @@ class Megatools:
 
         Args:
             url (str): A valid mega.nz download url
-            progress (Callable, optional): A function that accepts the `output stream` and `process` and uses it display progress. Defaults to default_callback
+            progress (Callable, optional): A function that accepts the `output stream`, the last `chunk` read and `process` and uses it display progress. Defaults to default_callback
             async (bool, optional): Assume that `progress` is async
             *args: Optional arguments to be passed on to `progress` function
 
@@ -162,8 +278,19 @@ class Megatools:
             return self.async_download(url, progress, progress_arguments, **options)
         command = [self.executable, "dl", url, "--no-ask-password"]
         parse_options(command, **options)
+        return self._execute(command, progress, progress_arguments)
+
+    def _execute(
+        self,
+        command: list[str],
+        progress: Optional[Callable],
+        progress_arguments: tuple = (),
+        on_spawn: Optional[Callable] = None,
+    ) -> tuple[str, int]:
         logger.info(f"Executing: {command}")
-        stdout, stderr, returncode = execute(command, progress, *progress_arguments)
+        stdout, stderr, returncode = execute(
+            command, progress, *progress_arguments, on_spawn=on_spawn
+        )
         if stderr:
             parse_and_raise(returncode, stderr)
         return stdout, returncode
@@ -176,8 +303,18 @@ class Megatools:
         progress_arguments: tuple = (),
         **options,
     ) -> tuple[str, int]:
+        if progress is default_callback:
+            progress = default_async_callback
         command = [self.executable, "dl", url, "--no-ask-password"]
         parse_options(command, **options)
+        return await self._async_execute(command, progress, progress_arguments)
+
+    async def _async_execute(
+        self,
+        command: list[str],
+        progress: Optional[Callable],
+        progress_arguments: tuple = (),
+    ) -> tuple[str, int]:
         logger.info(f"Executing: {command}")
         stdout, stderr, returncode = await async_execute(
             command, progress, *progress_arguments
@@ -186,7 +323,51 @@ class Megatools:
             parse_and_raise(returncode, stderr)
         return stdout, returncode
 
-    @property
+    async def download_in_thread(
+        self,
+        url: str,
+        progress: Optional[Callable] = default_callback,
+        progress_arguments: tuple = (),
+        **options,
+    ) -> tuple[str, int]:
+        """Await a download that reports progress to a sync callback
+
+        The download runs on this instance's thread pool, so the event loop is not blocked and at most `max_workers` downloads run at once.
+        Cancelling the awaiting task kills the megatools process and frees its worker.
+        Takes the same arguments as `download`, except that `progress` must be sync and `assume_async` is not accepted.
+
+        Returns:
+            tuple[str, int]: The stdout and returncode.
+        """
+        assert not iscoroutinefunction(progress), "`progress` function must be sync!"
+        assert "assume_async" not in options, "`assume_async` is not supported here!"
+        command = [self.executable, "dl", url, "--no-ask-password"]
+        parse_options(command, **options)
+        cancelled = Event()
+        processes: list[Popen] = []
+
+        def on_spawn(process: Popen) -> None:
+            processes.append(process)
+            if cancelled.is_set():
+                process.kill()
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._get_executor(),
+                partial(self._execute, command, progress, progress_arguments, on_spawn),
+            )
+        except asyncio.CancelledError:
+            cancelled.set()
+            for process in processes:
+                process.kill()
+            raise
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        return self._executor
+
+    @cached_property
     def version(self) -> str:
         """Get version information of megatools
 
@@ -205,11 +386,46 @@ class Megatools:
         Returns:
             str: The name of the file
         """
-        stdout, _ = self.download(
+        command = [
+            self.executable,
+            "dl",
             url,
-            progress=lambda stream, process: stream[-1] and process.terminate(),
-            print_names=True,
-            limit_speed=1,
-            path=str(self.tmp_directory),
+            "--no-ask-password",
+            "--print-names",
+            "--limit-speed=1",
+            f"--path={self.tmp_directory}",
+        ]
+        stdout, _ = self._execute(
+            command, lambda stream, chunk, process: process.terminate()
         )
         return stdout.split(":")[0]
+
+    def filenames(
+        self, urls: Sequence[str], max_workers: int = FILENAME_WORKERS
+    ) -> list[str]:
+        """Get the names of several files from valid mega.nz urls
+
+        The lookups run concurrently, so the megatools startup cost is paid in parallel instead of once per url in turn.
+
+        Args:
+            urls (Sequence[str]): Valid mega.nz urls
+            max_workers (int, optional): Maximum number of lookups run at once. Defaults to FILENAME_WORKERS (8)
+
+        Returns:
+            list[str]: The name of each file, in the same order as `urls`
+        """
+        workers = max(1, min(len(urls), max_workers))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(self.filename, urls))
+
+    def close(self) -> None:
+        """Shut down the thread pool used by `download_in_thread`, waiting for running downloads to finish"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self) -> "Megatools":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()